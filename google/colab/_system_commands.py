@@ -39,6 +39,11 @@ from google.colab.output import _tags
 # Linux read(2) limits to 0x7ffff000 so stay under that for clarity.
 _PTY_READ_MAX_BYTES_FOR_TEST = 2**20  # 1MB
 
+# Optional callback invoked (with no arguments) when the subprocess appears to
+# be blocked waiting for input. Used by tests to provide input only once the
+# subprocess is ready for it.
+_ON_STDIN_REQUEST_FOR_TEST = None
+
 _BIN_BASH = os.environ.get('BIN_BASH_OVERRIDE_FOR_TEST', '/bin/bash')
 _ENCODING = 'UTF-8'
 
@@ -207,6 +212,7 @@ class _MonitorProcessState(object):
   def __init__(self):
     self.process_output = six.StringIO()
     self.is_pty_still_connected = True
+    self.previous_poll_idle = False
 
 
 def _monitor_process(parent_pty, epoll, p, cmd, update_stdin_widget):
@@ -293,6 +299,16 @@ def _poll_process(parent_pty, epoll, p, cmd, decoder, state):
     if (event & select.EPOLLHUP) or (event & select.EPOLLERR):
       state.is_pty_still_connected = False
 
+  # The subprocess is likely blocked waiting for input if it produced no output
+  # during both this and the previous poll. Restart the idle window after each
+  # notification so the subprocess can react to any input it is given.
+  awaiting_input = (
+      bool(input_events) and not output_available and
+      state.previous_poll_idle)
+  state.previous_poll_idle = not output_available and not awaiting_input
+  if awaiting_input and _ON_STDIN_REQUEST_FOR_TEST is not None:
+    _ON_STDIN_REQUEST_FOR_TEST()
+
   for event in input_events:
     # Check to see if there is any input on the stdin socket.
     # pylint: disable=protected-access
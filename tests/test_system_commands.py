@@ -12,7 +12,11 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Tests for the google.colab._system_commands package."""
+"""Tests for the google.colab._system_commands package.
+
+The tests are independent of each other and can be run in parallel, e.g. with
+`pytest -n auto tests/test_system_commands.py`.
+"""
 
 from __future__ import absolute_import
 from __future__ import division
@@ -21,29 +25,91 @@ from __future__ import print_function
 import collections
 import contextlib
 import os
+import queue
 import signal
-import textwrap
 import threading
-import time
 import unittest
+from unittest import mock  # pylint:disable=g-importing-member
 
 from google.colab import _ipython
 from google.colab import _message
 from google.colab import _system_commands
 
-import IPython
 from IPython.core import interactiveshell
 from IPython.lib import pretty
 from IPython.utils import io
 
-import six
+_STDIN_DISABLED_CELL = """
+import subprocess
+try:
+  %shell read result
+except subprocess.CalledProcessError as e:
+  caught_exception = e
+"""
+
+_ERROR_PROPAGATES_CELL = """
+import subprocess
+try:
+  %shell /bin/false
+except subprocess.CalledProcessError as e:
+  caught_exception = e
+"""
+
+_IGNORE_ERRORS_CELL = """
+%%shell --ignore-errors
+/bin/false
+"""
+
+_INTERRUPTIBLE_READ_CELL = """
+%%shell --ignore-errors
+echo 'Before sleep'
+read -t 600
+echo 'Invalid. Read call should never terminate.'
+"""
+
+_SIGINT_IGNORED_READ_CELL = """
+%%shell --ignore-errors
+# Trapping with an empty command causes the signal to be ignored.
+trap '' SIGINT
+echo 'Before sleep'
+read -t 600
+echo 'Invalid. Read call should never terminate.'
+"""
+
+_SIGINT_SIGTERM_IGNORED_READ_CELL = """
+%%shell --ignore-errors
+# Trapping with an empty command causes the signal to be ignored.
+trap '' SIGINT SIGTERM
+echo 'Before sleep'
+read -t 600
+echo 'Invalid. Read call should never terminate.'
+"""
 
-# pylint:disable=g-import-not-at-top
+_NON_UTF8_LOCALE_CELL = """
+import subprocess
 try:
-  import unittest.mock as mock
-except ImportError:
-  import mock
-# pylint:enable=g-import-not-at-top
+  %shell echo "should fail"
+except NotImplementedError as e:
+  caught_exception = e
+"""
+
+_SYSTEM_COMPAT_VAR_EXPANSION_CELL = u"""
+def some_func():
+  local_var = 'Hello there'
+  !echo "{local_var}"
+some_func()
+"""
+
+_GETOUTPUT_COMPAT_VAR_EXPANSION_CELL = u"""
+def some_func():
+  local_var = 'Hello there'
+  # The result of "!!" cannot be assigned or returned. Write the contents
+  # to a file and return that instead.
+  !!echo "{local_var}" > /tmp/getoutputwithvarexpansion.txt
+  with open('/tmp/getoutputwithvarexpansion.txt', 'r') as f:
+    print(f.read())
+some_func()
+"""
 
 
 class FakeShell(interactiveshell.InteractiveShell):
@@ -55,6 +121,24 @@ class FakeShell(interactiveshell.InteractiveShell):
     return _system_commands._getoutput_compat(self, *args, **kwargs)
 
 
+_SHARED_SHELL = None
+
+
+def _shared_shell():
+  """Returns the FakeShell shared by all tests in this process.
+
+  The shell is built and has the magics registered on first use, then reused
+  by every test running in the same process (e.g. the same pytest-xdist
+  worker).
+  """
+  global _SHARED_SHELL
+  if _SHARED_SHELL is None:
+    _SHARED_SHELL = FakeShell.instance()
+    _SHARED_SHELL.kernel = mock.Mock()
+    _system_commands._register_magics(_SHARED_SHELL)
+  return _SHARED_SHELL
+
+
 class RunCellResult(
     collections.namedtuple('RunCellResult',
                            ('output', 'update_calls', 'stdout_flushes'))):
@@ -72,17 +156,69 @@ class SystemCommandsTest(unittest.TestCase):
   @classmethod
   def setUpClass(cls):
     super(SystemCommandsTest, cls).setUpClass()
-    ipython = FakeShell.instance()
-    ipython.kernel = mock.Mock()
-    cls.ip = IPython.get_ipython()
-
     cls.orig_pty_max_read_bytes = _system_commands._PTY_READ_MAX_BYTES_FOR_TEST
 
+    # Why execute in a separate thread? The shell magic blocks until the
+    # process completes, so running it on a worker thread lets run_cell give up
+    # on a cell that never finishes. A single long-lived thread runs every cell,
+    # so the shell is only ever used from one thread.
+    cls._start_worker()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.job_queue.put(None)
+    cls.worker.join(30)
+    super(SystemCommandsTest, cls).tearDownClass()
+
+  @classmethod
+  def _start_worker(cls):
+    cls.job_queue = queue.Queue()
+    cls.worker = threading.Thread(
+        target=cls._process_jobs, args=(cls.job_queue,))
+    cls.worker.daemon = True
+    cls.worker.start()
+
+  @staticmethod
+  def _process_jobs(job_queue):
+    while True:
+      item = job_queue.get()
+      if item is None:
+        return
+      job, result_queue = item
+      try:
+        result_queue.put((job(), None))
+      except Exception as e:  # pylint:disable=broad-except
+        result_queue.put((None, e))
+
   def setUp(self):
     super(SystemCommandsTest, self).setUp()
-    self.ip.reset()
+    self.ip = _shared_shell()
+
+    # Resetting the whole shell is expensive; only clear the variables that
+    # tests assert on.
+    for name in ('r', '_', 'caught_exception', '_exit_code'):
+      self.ip.user_ns.pop(name, None)
     _system_commands._PTY_READ_MAX_BYTES_FOR_TEST = self.orig_pty_max_read_bytes
 
+    # The mocks are started once per test; run_cell only swaps in the side
+    # effects for the cell being executed.
+    message_patcher = mock.patch.multiple(
+        _message, _read_stdin_message=mock.DEFAULT)
+    self.mock_read_stdin_message = (
+        message_patcher.start()['_read_stdin_message'])
+    self.addCleanup(message_patcher.stop)
+
+    system_commands_patcher = mock.patch.multiple(
+        _system_commands,
+        _display_stdin_widget=mock.DEFAULT,
+        _ON_STDIN_REQUEST_FOR_TEST=mock.DEFAULT)
+    system_commands_mocks = system_commands_patcher.start()
+    self.addCleanup(system_commands_patcher.stop)
+    self.mock_display_stdin_widget = (
+        system_commands_mocks['_display_stdin_widget'])
+    self.mock_on_stdin_request = system_commands_mocks[
+        '_ON_STDIN_REQUEST_FOR_TEST']
+
   def testSubprocessOutputCaptured(self):
     run_cell_result = self.run_cell("""
 r = %shell echo -n "hello err, " 1>&2 && echo -n "hello out, " && echo "bye..."
@@ -91,7 +227,8 @@ r = %shell echo -n "hello err, " 1>&2 && echo -n "hello out, " && echo "bye..."
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual('hello err, hello out, bye...\n', captured_output.stdout)
-    result = self.ip.user_ns['r']
+    ns = self.ip.user_ns
+    result = ns['r']
     self.assertEqual(0, result.returncode)
     self.assertEqual('hello err, hello out, bye...\n', result.output)
 
@@ -107,7 +244,8 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
     self.assertEqual('', captured_output.stderr)
     self.assertEqual('cats\nFirst: cats\nSecond: dogs\n',
                      captured_output.stdout)
-    result = self.ip.user_ns['r']
+    ns = self.ip.user_ns
+    result = ns['r']
     self.assertEqual(0, result.returncode)
     self.assertEqual('cats\nFirst: cats\nSecond: dogs\n', result.output)
     # Updates correspond to:
@@ -123,24 +261,19 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
       self.assertEqual('', captured_output.stderr)
       self.assertEqual('hello world\n', captured_output.stdout)
-      result = self.ip.user_ns['r']
+      ns = self.ip.user_ns
+      result = ns['r']
       self.assertEqual(result.returncode, 0)
 
   def testStdinDisabled(self):
     with temp_env(COLAB_DISABLE_STDIN_FOR_SHELL_MAGICS='1'):
-      run_cell_result = self.run_cell(
-          textwrap.dedent("""
-        import subprocess
-        try:
-          %shell read result
-        except subprocess.CalledProcessError as e:
-          caught_exception = e
-        """))
+      run_cell_result = self.run_cell(_STDIN_DISABLED_CELL)
       captured_output = run_cell_result.output
 
       self.assertEqual('', captured_output.stderr)
       self.assertEqual('', captured_output.stdout)
-      result = self.ip.user_ns['caught_exception']
+      ns = self.ip.user_ns
+      result = ns['caught_exception']
       self.assertEqual(1, result.returncode)
       self.assertEqual('', result.output)
 
@@ -152,7 +285,8 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual('cats\nYou typed: cats\n', captured_output.stdout)
-    result = self.ip.user_ns['r']
+    ns = self.ip.user_ns
+    result = ns['r']
     self.assertEqual(0, result.returncode)
     self.assertEqual('cats\nYou typed: cats\n', result.output)
 
@@ -172,42 +306,53 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
     # to CR-NL on output:
     # http://git.savannah.gnu.org/cgit/bash.git/tree/lib/sh/shtty.c?id=64447609994bfddeef1061948022c074093e9a9f#n128
     self.assertEqual('cats\r\nYou typed: c\n', captured_output.stdout)
-    result = self.ip.user_ns['r']
+    ns = self.ip.user_ns
+    result = ns['r']
     self.assertEqual(0, result.returncode)
     self.assertEqual('cats\r\nYou typed: c\n', result.output)
 
+  def testStdinRequestedWhileBlockedOnRead(self):
+    run_cell_result = self.run_cell('r = %shell read -t 1 result; echo "done"')
+    captured_output = run_cell_result.output
+
+    self.assertEqual('', captured_output.stderr)
+    self.assertEqual('done\n', captured_output.stdout)
+    self.assertTrue(self.mock_on_stdin_request.called)
+
+  def testStdinNotRequestedWhileOutputStreams(self):
+    # Output is produced every 10ms, faster than the monitor loop polls while
+    # idle, so there are never two consecutive polls without output.
+    run_cell_result = self.run_cell(
+        'r = %shell for i in {1..50}; do echo "$i"; sleep 0.01; done')
+    captured_output = run_cell_result.output
+
+    self.assertEqual('', captured_output.stderr)
+    self.assertEqual(50, len(captured_output.stdout.splitlines()))
+    self.mock_on_stdin_request.assert_not_called()
+
   def testSubprocessHasPTY(self):
     run_cell_result = self.run_cell('r = %shell tty')
     captured_output = run_cell_result.output
 
     self.assertEqual('', captured_output.stderr)
     self.assertIn('/dev/pts/', captured_output.stdout)
-    result = self.ip.user_ns['r']
+    ns = self.ip.user_ns
+    result = ns['r']
     self.assertEqual(result.returncode, 0)
 
   def testErrorPropagatesByDefault(self):
-    run_cell_result = self.run_cell(
-        textwrap.dedent("""
-      import subprocess
-      try:
-        %shell /bin/false
-      except subprocess.CalledProcessError as e:
-        caught_exception = e
-      """))
+    run_cell_result = self.run_cell(_ERROR_PROPAGATES_CELL)
     captured_output = run_cell_result.output
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual('', captured_output.stdout)
-    result = self.ip.user_ns['caught_exception']
+    ns = self.ip.user_ns
+    result = ns['caught_exception']
     self.assertEqual(1, result.returncode)
     self.assertEqual('', result.output)
 
   def testIgnoreErrorsDoesNotPropagate(self):
-    run_cell_result = self.run_cell(
-        textwrap.dedent("""
-      %%shell --ignore-errors
-      /bin/false
-      """))
+    run_cell_result = self.run_cell(_IGNORE_ERRORS_CELL)
     captured_output = run_cell_result.output
 
     self.assertEqual('', captured_output.stderr)
@@ -216,7 +361,8 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
     # versions of IPython don't appear to capture this prompt in the stdout
     # stream. Due to this, we don't assert anything about the stdout output. If
     # an error is thrown, then accessing the "_" variable will fail.
-    result = self.ip.user_ns['_']
+    ns = self.ip.user_ns
+    result = ns['_']
     self.assertEqual(1, result.returncode)
     self.assertEqual('', result.output)
 
@@ -227,7 +373,8 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual(100, len(captured_output.stdout))
-    result = self.ip.user_ns['r']
+    ns = self.ip.user_ns
+    result = ns['r']
     self.assertEqual(0, result.returncode)
     self.assertEqual(1, run_cell_result.stdout_flushes)
 
@@ -238,7 +385,8 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual('/bin/bash\n', captured_output.stdout)
-    result = self.ip.user_ns['r']
+    ns = self.ip.user_ns
+    result = ns['r']
     self.assertEqual(0, result.returncode)
     self.assertEqual('/bin/bash\n', result.output)
 
@@ -249,7 +397,8 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual(u'Dogs is 小狗', captured_output.stdout)
-    result = self.ip.user_ns['r']
+    ns = self.ip.user_ns
+    result = ns['r']
     self.assertEqual(0, result.returncode)
     self.assertEqual(u'Dogs is 小狗', result.output)
 
@@ -260,7 +409,8 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual(u'�Yay', captured_output.stdout)
-    result = self.ip.user_ns['r']
+    ns = self.ip.user_ns
+    result = ns['r']
     self.assertEqual(0, result.returncode)
     self.assertEqual(u'�Yay', result.output)
 
@@ -275,7 +425,8 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual(u'猫\nYou typed: 猫\n', captured_output.stdout)
-    result = self.ip.user_ns['r']
+    ns = self.ip.user_ns
+    result = ns['r']
     self.assertEqual(0, result.returncode)
     self.assertEqual(u'猫\nYou typed: 猫\n', result.output)
 
@@ -286,72 +437,54 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
   def testFirstInterruptSendsSigInt(self):
     run_cell_result = self.run_cell(
-        textwrap.dedent("""
-      %%shell --ignore-errors
-      echo 'Before sleep'
-      read -t 600
-      echo 'Invalid. Read call should never terminate.'
-      """),
-        provided_inputs=['interrupt'])
+        _INTERRUPTIBLE_READ_CELL, provided_inputs=['interrupt'])
     captured_output = run_cell_result.output
 
     self.assertEqual('', captured_output.stderr)
-    result = self.ip.user_ns['_']
+    ns = self.ip.user_ns
+    result = ns['_']
     self.assertEqual(-signal.SIGINT, result.returncode)
     self.assertEqual('Before sleep\n', result.output)
 
   def testSecondInterruptSendsSigTerm(self):
+    # The cell would otherwise block in "read -t 600", so fail quickly if the
+    # interrupts don't terminate it.
     run_cell_result = self.run_cell(
-        textwrap.dedent("""
-      %%shell --ignore-errors
-      # Trapping with an empty command causes the signal to be ignored.
-      trap '' SIGINT
-      echo 'Before sleep'
-      read -t 600
-      echo 'Invalid. Read call should never terminate.'
-      """),
-        provided_inputs=['interrupt', 'interrupt'])
+        _SIGINT_IGNORED_READ_CELL,
+        provided_inputs=['interrupt', 'interrupt'],
+        timeout=10)
     captured_output = run_cell_result.output
 
     self.assertEqual('', captured_output.stderr)
-    result = self.ip.user_ns['_']
+    ns = self.ip.user_ns
+    result = ns['_']
     self.assertEqual(-signal.SIGTERM, result.returncode)
     self.assertEqual('Before sleep\n', result.output)
 
   def testSecondInterruptSendsSigKillAfterSigterm(self):
+    # As above; the SIGKILL is only sent 0.5 seconds after the SIGTERM.
     run_cell_result = self.run_cell(
-        textwrap.dedent("""
-      %%shell --ignore-errors
-      # Trapping with an empty command causes the signal to be ignored.
-      trap '' SIGINT SIGTERM
-      echo 'Before sleep'
-      read -t 600
-      echo 'Invalid. Read call should never terminate.'
-      """),
-        provided_inputs=['interrupt', 'interrupt'])
+        _SIGINT_SIGTERM_IGNORED_READ_CELL,
+        provided_inputs=['interrupt', 'interrupt'],
+        timeout=10)
     captured_output = run_cell_result.output
 
     self.assertEqual('', captured_output.stderr)
-    result = self.ip.user_ns['_']
+    ns = self.ip.user_ns
+    result = ns['_']
     self.assertEqual(-signal.SIGKILL, result.returncode)
     self.assertEqual('Before sleep\n', result.output)
 
   def testNonUtf8Locale(self):
     # The "C" locale uses the US-ASCII 7-bit character set.
     with temp_env(LC_ALL='C'):
-      run_cell_result = self.run_cell(
-          textwrap.dedent("""
-        import subprocess
-        try:
-          %shell echo "should fail"
-        except NotImplementedError as e:
-          caught_exception = e
-        """))
+      run_cell_result = self.run_cell(_NON_UTF8_LOCALE_CELL)
       captured_output = run_cell_result.output
 
       self.assertEqual('', captured_output.stderr)
       self.assertEqual('', captured_output.stdout)
-      self.assertIsNotNone(self.ip.user_ns['caught_exception'])
+      ns = self.ip.user_ns
+      self.assertIsNotNone(ns['caught_exception'])
 
   def testSystemCompat(self):
     _system_commands._PTY_READ_MAX_BYTES_FOR_TEST = 1
@@ -362,8 +495,9 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual(u'猫\nYou typed: 猫\n', captured_output.stdout)
-    self.assertEqual(0, self.ip.user_ns['_exit_code'])
-    self.assertNotIn('_', self.ip.user_ns)
+    ns = self.ip.user_ns
+    self.assertEqual(0, ns['_exit_code'])
+    self.assertNotIn('_', ns)
 
   def testSystemCompatWithInterrupt(self):
     run_cell_result = self.run_cell('!read res', provided_inputs=['interrupt'])
@@ -371,23 +505,20 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual(u'^C\n', captured_output.stdout)
-    self.assertEqual(-signal.SIGINT, self.ip.user_ns['_exit_code'])
-    self.assertNotIn('_', self.ip.user_ns)
+    ns = self.ip.user_ns
+    self.assertEqual(-signal.SIGINT, ns['_exit_code'])
+    self.assertNotIn('_', ns)
 
   def testSystemCompatWithVarExpansion(self):
-    cmd = textwrap.dedent(u"""
-      def some_func():
-        local_var = 'Hello there'
-        !echo "{local_var}"
-      some_func()
-      """)
-    run_cell_result = self.run_cell(cmd, provided_inputs=[])
+    run_cell_result = self.run_cell(
+        _SYSTEM_COMPAT_VAR_EXPANSION_CELL, provided_inputs=[])
     captured_output = run_cell_result.output
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual(u'Hello there\n', captured_output.stdout)
-    self.assertEqual(0, self.ip.user_ns['_exit_code'])
-    self.assertNotIn('_', self.ip.user_ns)
+    ns = self.ip.user_ns
+    self.assertEqual(0, ns['_exit_code'])
+    self.assertNotIn('_', ns)
 
   def testGetOutputCompat(self):
     # "猫" is "cats" in simplified Chinese.
@@ -396,15 +527,12 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
     captured_output = run_cell_result.output
 
     self.assertEqual('', captured_output.stderr)
-    self.assertNotIn('_exit_code', self.ip.user_ns.keys())
-    result = self.ip.user_ns['_']
+    ns = self.ip.user_ns
+    self.assertNotIn('_exit_code', ns.keys())
+    result = ns['_']
     self.assertEqual(2, len(result))
-    if six.PY2:
-      self.assertEqual(u'猫'.encode('UTF-8'), result[0])
-      self.assertEqual(u'You typed: 猫'.encode('UTF-8'), result[1])
-    else:
-      self.assertEqual(u'猫', result[0])
-      self.assertEqual(u'You typed: 猫', result[1])
+    self.assertEqual(u'猫', result[0])
+    self.assertEqual(u'You typed: 猫', result[1])
 
   def testGetOutputCompatWithInterrupt(self):
     run_cell_result = self.run_cell('!!read res', provided_inputs=['interrupt'])
@@ -412,94 +540,75 @@ r = %shell read r1 && echo "First: $r1" && read -s r2 && echo "Second: $r2"
 
     self.assertEqual('', captured_output.stderr)
     self.assertIn(u'^C\n', captured_output.stdout)
-    result = self.ip.user_ns['_']
+    ns = self.ip.user_ns
+    result = ns['_']
     self.assertEqual(0, len(result))
 
   def testGetOutputCompatWithVarExpansion(self):
-    cmd = textwrap.dedent(u"""
-      def some_func():
-        local_var = 'Hello there'
-        # The result of "!!" cannot be assigned or returned. Write the contents
-        # to a file and return that instead.
-        !!echo "{local_var}" > /tmp/getoutputwithvarexpansion.txt
-        with open('/tmp/getoutputwithvarexpansion.txt', 'r') as f:
-          print(f.read())
-      some_func()
-      """)
-    run_cell_result = self.run_cell(cmd, provided_inputs=[])
+    run_cell_result = self.run_cell(
+        _GETOUTPUT_COMPAT_VAR_EXPANSION_CELL, provided_inputs=[])
     captured_output = run_cell_result.output
 
     self.assertEqual('', captured_output.stderr)
     self.assertEqual(u'Hello there\n\n', captured_output.stdout)
 
-  def run_cell(self, cell_contents, provided_inputs=None):
+  def run_cell(self, cell_contents, provided_inputs=None, timeout=30):
     """Execute the cell contents, optionally providing input to the subprocess.
 
     Args:
       cell_contents: Code to execute.
       provided_inputs: Input provided to the executing shell magic.
+      timeout: Maximum number of seconds to wait for the cell to finish.
 
     Returns:
       A RunCellResult containing information about the executed cell.
     """
 
-    # Why execute in a separate thread? The shell magic blocks until the
-    # process completes, even if it is blocking on input. As such, we need to
-    # asynchronously provide input by periodically popping the content and
-    # forwarding it to the subprocess.
-    def worker(inputs, result_container):
+    inputs = collections.deque(provided_inputs or [])
+
+    def job():
+      # Only hand out the next input once _system_commands reports that the
+      # subprocess is waiting for it, rather than after a fixed delay.
+      stdin_requested = threading.Event()
 
       def mock_stdin_provider():
-        if not inputs:
+        if not stdin_requested.is_set() or not inputs:
           return None
 
-        val = inputs.pop(0)
+        stdin_requested.clear()
+        val = inputs.popleft()
         if val == 'interrupt':
           raise KeyboardInterrupt
         return val
 
       mock_stdin_widget, echo_updater_calls = create_mock_stdin_widget()
-      with \
-        mock.patch.object(
-            _message,
-            '_read_stdin_message',
-            side_effect=mock_stdin_provider,
-            autospec=True), \
-        mock.patch.object(
-            _system_commands,
-            '_display_stdin_widget',
-            mock_stdin_widget):
-        _system_commands._register_magics(self.ip)
-
-        with io.capture_output() as captured:
-          with mock.patch.object(
-              captured._stdout, 'flush',
-              wraps=captured._stdout.flush) as stdout_flushes:
-            self.ip.run_cell(cell_contents)
-
-        run_cell_result = RunCellResult(captured, echo_updater_calls,
-                                        stdout_flushes.call_count)
-        result_container['run_cell_result'] = run_cell_result
-
-    result = {}
-    input_queue = []
-    t = threading.Thread(
-        target=worker, args=(
-            input_queue,
-            result,
-        ))
-    t.daemon = True
-    t.start()
-
-    provided_inputs = provided_inputs or []
-    for provided_input in provided_inputs:
-      time.sleep(2)
-      input_queue.append(provided_input)
-
-    t.join(30)
-    self.assertFalse(t.is_alive())
-
-    return result['run_cell_result']
+      self.mock_read_stdin_message.side_effect = mock_stdin_provider
+      self.mock_display_stdin_widget.side_effect = mock_stdin_widget
+      self.mock_on_stdin_request.side_effect = stdin_requested.set
+      with io.capture_output() as captured:
+        with mock.patch.object(
+            captured._stdout, 'flush',
+            wraps=captured._stdout.flush) as stdout_flushes:
+          self.ip.run_cell(cell_contents)
+
+      return RunCellResult(captured, echo_updater_calls,
+                           stdout_flushes.call_count)
+
+    result_queue = queue.Queue()
+    self.job_queue.put((job, result_queue))
+    try:
+      run_cell_result, error = result_queue.get(timeout=timeout)
+    except queue.Empty:
+      run_cell_result = error = None
+    if run_cell_result is None and error is None:
+      # The worker is still busy with this cell. Let it exit once the cell
+      # finishes and hand later cells to a fresh worker.
+      self.job_queue.put(None)
+      self._start_worker()
+      self.fail('Cell did not finish within {} seconds'.format(timeout))
+    if error is not None:
+      raise error
+    return run_cell_result
 
 
 class DisplayStdinWidgetTest(unittest.TestCase):
@@ -524,13 +633,16 @@ class DisplayStdinWidgetTest(unittest.TestCase):
 
 @contextlib.contextmanager
 def temp_env(**env_variables):
-  old_env = dict(os.environ)
+  saved = {k: os.environ.get(k) for k in env_variables}
   os.environ.update(env_variables)
   try:
     yield
   finally:
-    os.environ.clear()
-    os.environ.update(old_env)
+    for k, v in saved.items():
+      if v is None:
+        os.environ.pop(k, None)
+      else:
+        os.environ[k] = v
 
 
 def create_mock_stdin_widget():